@@ -0,0 +1,48 @@
+"""Integer averaging kernels used by the internal blend in server.py.
+
+Numba is optional. When it is installed the loops below are JIT-compiled
+without the GIL and cached to disk so warm starts skip compilation; without it
+the same operations run as in-place NumPy ufuncs. The kernels are deliberately
+serial: they are called from request worker threads, where Numba's default
+workqueue threading layer is not safe to start, and decoding is already spread
+across threads.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    # Missing, or installed against an unsupported NumPy; fall back either way.
+    njit = None
+
+
+if njit is not None:
+
+    @njit(nogil=True, cache=True)
+    def accumulate(acc, img):
+        # acc += img, one pass over the rows with no temporaries.
+        h, w, c = img.shape
+        for y in range(h):
+            for x in range(w):
+                for k in range(c):
+                    acc[y, x, k] += img[y, x, k]
+
+    @njit(nogil=True, cache=True)
+    def finalize_mean(acc, n, out):
+        # out = round(acc / n), written straight into the uint8 destination.
+        half = n >> 1
+        h, w, c = acc.shape
+        for y in range(h):
+            for x in range(w):
+                for k in range(c):
+                    out[y, x, k] = (acc[y, x, k] + half) // n
+
+else:
+
+    def accumulate(acc, img):
+        np.add(acc, img, out=acc)
+
+    def finalize_mean(acc, n, out):
+        # Rounds in place, so acc must be re-zeroed before reuse.
+        np.add(acc, n >> 1, out=acc)
+        np.floor_divide(acc, n, out=out, casting="unsafe")
@@ -25,11 +25,14 @@ def average_images(image_folder, output_file):
     width, height = images[0].size
     images = [img.resize((width, height)) for img in images]
 
-    # Convert to numpy arrays
-    np_images = np.array([np.array(img, dtype=np.float32) for img in images])
+    # Sum in uint32 (this script has no image-count cap), then round-divide
+    n = len(images)
+    acc = np.zeros((height, width, 4), dtype=np.uint32)
+    for img in images:
+        acc += np.asarray(img, dtype=np.uint8)
 
     # Compute average
-    avg_array = np.mean(np_images, axis=0).astype(np.uint8)
+    avg_array = ((acc + (n >> 1)) // n).astype(np.uint8)
 
     # Save blended image
     blended = Image.fromarray(avg_array)
@@ -1,15 +1,40 @@
-from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi import FastAPI, File, HTTPException, Request, UploadFile
 from fastapi.responses import JSONResponse, Response
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 from PIL import Image
 import io
+import numpy as np
 import os
 import secrets
 import tempfile
-import importlib
+import threading
 import sys
 
+# Make sibling modules (blend.py, _blend_kernel.py) importable.
+_HERE = Path(__file__).parent
+if str(_HERE) not in sys.path:
+    sys.path.insert(0, str(_HERE))
+
+from _blend_kernel import accumulate, finalize_mean
+
+# Optional: libvips streams the whole average through memory in strips.
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
+# Optional: if api/blend.py exists with blend_images_from_files or blend_images.
+# Resolved once at import so requests only read the cached hooks. Any import
+# failure just disables the hooks so the app (and health route) still starts.
+try:
+    import blend as _blend_mod
+except Exception:
+    _blend_mod = None
+_blend_from_files = getattr(_blend_mod, "blend_images_from_files", None)
+_blend_from_paths = getattr(_blend_mod, "blend_images", None)
+
 app = FastAPI(title="Image Blender API", version="1.0.0")
 
 # Small limits for Vercel
@@ -18,7 +43,10 @@ MAX_FILES = 15
 MAX_FILE_MB = 4
 MAX_FILE_BYTES = MAX_FILE_MB * 1024 * 1024
 ACCEPTED_EXTS = {".png", ".jpg", ".jpeg", ".webp"}
-ACCEPTED_MEDIA_TYPES = {"image/png", "image/jpeg", "image/webp"}
+ACCEPTED_SUFFIXES = tuple(ACCEPTED_EXTS)  # for str.endswith
+ACCEPTED_MEDIA_TYPES = frozenset({"image/png", "image/jpeg", "image/webp"})
+ACCEPTED_FORMATS = {"PNG", "JPEG", "MPO", "WEBP"}  # MPO: multi-frame camera JPEGs
+WEBP_MAX_SIDE = 16383  # libwebp's hard limit per dimension
 
 
 def _sanitize_filename(name: str) -> str:
@@ -29,22 +57,47 @@ def _sanitize_filename(name: str) -> str:
     return f"{(stem or 'img')[:40]}_{secrets.token_hex(4)}{ext}"
 
 
-async def _save_and_read(upload: UploadFile, dest: Path) -> bytes:
+async def _read_upload(upload: UploadFile) -> bytes:
+    # Chunks are joined once at the end: one allocation, one copy per chunk.
+    chunks: List[bytes] = []
     total = 0
-    dest.parent.mkdir(parents=True, exist_ok=True)
-    with dest.open("wb") as f_out:
-        while True:
-            chunk = await upload.read(1024 * 1024)
-            if not chunk:
-                break
-            total += len(chunk)
-            if total > MAX_FILE_BYTES:
-                raise HTTPException(
-                    status_code=413,
-                    detail=f"File '{upload.filename}' exceeds {MAX_FILE_MB} MB limit.",
-                )
-            f_out.write(chunk)
-    return dest.read_bytes()
+    while True:
+        chunk = await upload.read(1024 * 1024)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > MAX_FILE_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File '{upload.filename}' exceeds {MAX_FILE_MB} MB limit.",
+            )
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _verify_image(upload: UploadFile, data: bytes) -> None:
+    # Header/structure check only; pixels are not decoded.
+    try:
+        with Image.open(io.BytesIO(data)) as probe:
+            fmt = probe.format
+            probe.verify()
+    except Exception:
+        fmt = None
+    if fmt not in ACCEPTED_FORMATS:
+        raise HTTPException(
+            status_code=415,
+            detail=f"File '{upload.filename}' is not a valid PNG, JPEG, or WebP image.",
+        )
+
+
+def _spill_to_disk(names: List[str], file_bytes: List[bytes], temp_dir: Path) -> List[Path]:
+    # Only needed for path-based user blends; the other paths stay in memory.
+    paths: List[Path] = []
+    for name, data in zip(names, file_bytes):
+        dest = temp_dir / _sanitize_filename(name)
+        dest.write_bytes(data)
+        paths.append(dest)
+    return paths
 
 
 def _ensure_pillow_image(obj: Union[Image.Image, str, bytes, io.BytesIO]) -> Image.Image:
@@ -60,42 +113,122 @@ def _ensure_pillow_image(obj: Union[Image.Image, str, bytes, io.BytesIO]) -> Ima
     raise TypeError("Could not interpret blend result as an image.")
 
 
-def _blend_internal_average(paths: List[Path]) -> Image.Image:
-    # PIL-only incremental average (works on Vercel, no NumPy).
-    images = [Image.open(p).convert("RGBA") for p in paths]
-    if not images:
+def _has_alpha(im: Image.Image) -> bool:
+    return im.mode in ("RGBA", "LA", "PA", "RGBa", "La") or "transparency" in im.info
+
+
+def _is_wide(im: Image.Image) -> bool:
+    # 16-bit greyscale PNGs open as I;16* (or I on older Pillow).
+    return im.mode.startswith("I")
+
+
+def _is_colour_managed(im: Image.Image) -> bool:
+    # libvips converts CMYK and ICC-tagged inputs through their profiles, while
+    # Pillow's convert() maps channels naively.
+    return im.mode == "CMYK" or bool(im.info.get("icc_profile"))
+
+
+def _open_and_resize(data: bytes, size: Tuple[int, int], mode: str) -> Image.Image:
+    im = Image.open(io.BytesIO(data))
+    if _is_wide(im):
+        # Scale 16 bits down to 8 as libvips does; convert() would clip instead.
+        im = Image.fromarray((np.asarray(im, dtype=np.uint32) >> 8).astype(np.uint8))
+    im = im.convert(mode)
+    if im.size != size:
+        # Box-reduce by the integer factor first so resampling only covers the rest.
+        factor = min(im.width // size[0], im.height // size[1])
+        if factor >= 2:
+            im = im.reduce(factor)
+        if im.size != size:
+            # LANCZOS buys nothing visible for small scale changes; BILINEAR is far cheaper.
+            w, h = size
+            near = 0.9 <= im.width / w <= 1.1 and 0.9 <= im.height / h <= 1.1
+            resample = Image.BILINEAR if near else Image.LANCZOS
+            im = im.resize(size, resample)
+    return im
+
+
+def _blend_vips(file_bytes: List[bytes], size: Tuple[int, int], mode: str) -> Image.Image:
+    w, h = size
+    images = []
+    for data in file_bytes:
+        # thumbnail_buffer shrinks on load where the codec supports it. EXIF
+        # Orientation is ignored, as on the Pillow path, so both backends agree.
+        im = pyvips.Image.thumbnail_buffer(data, w, height=h, size="force", no_rotate=True)
+        if im.interpretation != "srgb":
+            im = im.colourspace("srgb")
+        if mode == "RGBA" and not im.hasalpha():
+            im = im.bandjoin(255)
+        elif mode == "RGB" and im.hasalpha():
+            im = im.extract_band(0, n=3)
+        images.append(im)
+    n = len(images)
+    out = pyvips.Image.sum(images).linear(1.0 / n, 0.5).cast("uchar")
+    return Image.frombuffer(mode, size, out.write_to_memory(), "raw", mode, 0, 1)
+
+
+def _blend_internal_average(file_bytes: List[bytes]) -> Image.Image:
+    # Fused decode -> resize -> accumulate: each input is added into a single
+    # uint16 accumulator (the rounded sum of up to 256 uint8 images) and freed.
+    if not file_bytes:
         raise ValueError("No images to blend.")
-    w, h = images[0].size
-    images = [im.resize((w, h), Image.LANCZOS) for im in images]
-    out = images[0]
-    for i, im in enumerate(images[1:], start=2):
-        out = Image.blend(out, im, 1.0 / i)
-    return out
-
-
-def _try_user_blend(file_bytes: List[bytes], file_paths: List[Path]) -> Optional[Image.Image]:
-    # Optional: if api/blend.py exists with blend_images_from_files or blend_images.
-    here = Path(__file__).parent
-    if str(here) not in sys.path:
-        sys.path.insert(0, str(here))
+    # Target the smallest input; only headers are read here. Blend in RGB
+    # unless some input carries alpha, saving a quarter of the bandwidth.
+    sizes = []
+    any_alpha = False
+    vips_ok = pyvips is not None
+    for data in file_bytes:
+        with Image.open(io.BytesIO(data)) as probe:
+            sizes.append(probe.size)
+            any_alpha = any_alpha or _has_alpha(probe)
+            # Inputs the two backends convert differently stay on the Pillow
+            # path so the result does not depend on whether pyvips is installed.
+            vips_ok = vips_ok and not _is_colour_managed(probe)
+    w, h = min(sizes, key=lambda wh: wh[0] * wh[1])
+    mode = "RGBA" if any_alpha else "RGB"
+    if vips_ok:
+        return _blend_vips(file_bytes, (w, h), mode)
+    n = len(file_bytes)
+    channels = len(mode)
+    acc = np.zeros((h, w, channels), dtype=np.uint16)
+    lock = threading.Lock()
+
+    def add(data: bytes) -> None:
+        arr = np.asarray(_open_and_resize(data, (w, h), mode), dtype=np.uint8)
+        with lock:
+            accumulate(acc, arr)
+
+    # Pillow releases the GIL while decoding and resampling, so threads scale;
+    # at most one decoded image per worker is alive at a time.
+    with ThreadPoolExecutor(max_workers=min(n, os.cpu_count() or 1)) as ex:
+        list(ex.map(add, file_bytes))
+    out = np.empty((h, w, channels), dtype=np.uint8)
+    finalize_mean(acc, n, out)
+    # Alias the result array instead of copying it; the image keeps it alive.
+    # RGB is still copied, since Pillow stores it padded to four bytes per pixel.
+    return Image.frombuffer(mode, (w, h), out, "raw", mode, 0, 1)
+
+
+def _try_user_blend_from_files(file_bytes: List[bytes]) -> Optional[Image.Image]:
+    if _blend_from_files is None:
+        return None
     try:
-        blend_mod = importlib.import_module("blend")
-    except ModuleNotFoundError:
+        return _ensure_pillow_image(_blend_from_files(file_bytes))
+    except Exception:
         return None
 
-    if hasattr(blend_mod, "blend_images_from_files"):
-        try:
-            return _ensure_pillow_image(blend_mod.blend_images_from_files(file_bytes))
-        except Exception:
-            pass
 
-    if hasattr(blend_mod, "blend_images"):
-        try:
-            result = blend_mod.blend_images([str(p) for p in file_paths])
-            return _ensure_pillow_image(result)
-        except Exception:
-            pass
-    return None
+def _try_user_blend_from_paths(file_paths: List[Path]) -> Optional[Image.Image]:
+    if _blend_from_paths is None:
+        return None
+    try:
+        result = _blend_from_paths([str(p) for p in file_paths])
+        image = _ensure_pillow_image(result)
+        # Force decoding before the temporary files are removed.
+        image.load()
+        return image
+    except Exception:
+        return None
 
 
 # Health: make both paths work
@@ -108,7 +241,7 @@ def health():
 # Blend: accept both paths
 @app.post("/")
 @app.post("/api/server")
-async def blend_endpoint(files: List[UploadFile] = File(...)) -> Response:
+async def blend_endpoint(request: Request, files: List[UploadFile] = File(...)) -> Response:
     if not files or len(files) < MIN_FILES or len(files) > MAX_FILES:
         raise HTTPException(
             status_code=422,
@@ -116,36 +249,42 @@ async def blend_endpoint(files: List[UploadFile] = File(...)) -> Response:
         )
 
     for uf in files:
-        ctype = (uf.content_type or "").lower()
-        ext_ok = Path(uf.filename or "").suffix.lower() in ACCEPTED_EXTS
-        if ctype not in ACCEPTED_MEDIA_TYPES and not ext_ok:
+        ctype_ok = (uf.content_type or "").lower() in ACCEPTED_MEDIA_TYPES
+        if not ctype_ok and not (uf.filename or "").lower().endswith(ACCEPTED_SUFFIXES):
             raise HTTPException(
                 status_code=415, detail="Only PNG, JPEG, or WebP images are allowed."
             )
 
     try:
-        with tempfile.TemporaryDirectory(dir="/tmp", prefix="blend_") as td:
-            temp_dir = Path(td)
-            file_bytes: List[bytes] = []
-            file_paths: List[Path] = []
-
-            for uf in files:
-                safe = _sanitize_filename(uf.filename or "image.png")
-                dest = temp_dir / safe
-                data = await _save_and_read(uf, dest)
-                file_bytes.append(data)
-                file_paths.append(dest)
-
-            image = _try_user_blend(file_bytes, file_paths)
-            if image is None:
-                image = _blend_internal_average(file_paths)
-
-            buf = io.BytesIO()
-            if image.mode not in ("RGB", "RGBA"):
-                image = image.convert("RGBA")
-            image.save(buf, format="PNG")
-            buf.seek(0)
-            return Response(content=buf.getvalue(), media_type="image/png")
+        file_bytes = [await _read_upload(uf) for uf in files]
+        for uf, data in zip(files, file_bytes):
+            _verify_image(uf, data)
+
+        image = _try_user_blend_from_files(file_bytes)
+        if image is None and _blend_from_paths is not None:
+            with tempfile.TemporaryDirectory(dir="/tmp", prefix="blend_") as td:
+                names = [uf.filename or "image.png" for uf in files]
+                file_paths = _spill_to_disk(names, file_bytes, Path(td))
+                image = _try_user_blend_from_paths(file_paths)
+        if image is None:
+            image = _blend_internal_average(file_bytes)
+
+        buf = io.BytesIO()
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        # WebP is much smaller for photographic blends; PNG stays the default
+        # and covers sizes libwebp cannot encode.
+        accepts_webp = "image/webp" in request.headers.get("accept", "").lower()
+        if accepts_webp and max(image.size) <= WEBP_MAX_SIDE:
+            image.save(buf, format="WEBP", quality=85, method=4)
+            media_type = "image/webp"
+        else:
+            # Fastest zlib level: encode time roughly halves for a modest size cost.
+            image.save(buf, format="PNG", compress_level=1)
+            media_type = "image/png"
+        return Response(
+            content=buf.getvalue(), media_type=media_type, headers={"Vary": "Accept"}
+        )
     except HTTPException:
         raise
     except Exception as exc:
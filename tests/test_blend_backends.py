@@ -0,0 +1,60 @@
+import io
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "api"))
+
+import server  # noqa: E402
+
+pytest.importorskip("pyvips")
+
+
+def _encode(im: Image.Image, fmt: str = "PNG", **kwargs) -> bytes:
+    buf = io.BytesIO()
+    im.save(buf, format=fmt, **kwargs)
+    return buf.getvalue()
+
+
+def _both_backends(monkeypatch, file_bytes):
+    vips = np.asarray(server._blend_internal_average(file_bytes), dtype=np.int16)
+    monkeypatch.setattr(server, "pyvips", None)
+    pil = np.asarray(server._blend_internal_average(file_bytes), dtype=np.int16)
+    return vips, pil
+
+
+def test_backends_ignore_exif_orientation(monkeypatch):
+    half_white = Image.new("RGB", (80, 40), (0, 0, 0))
+    half_white.paste((255, 255, 255), (0, 0, 40, 40))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 CW
+    rotated = _encode(half_white, "JPEG", quality=95, exif=exif.tobytes())
+    plain = _encode(Image.new("RGB", (80, 40), (100, 100, 100)))
+
+    vips, pil = _both_backends(monkeypatch, [rotated, plain])
+
+    assert vips.shape == pil.shape == (40, 80, 3)
+    assert np.abs(vips - pil).max() <= 8
+
+
+def test_backends_agree_on_16_bit_input(monkeypatch):
+    wide = _encode(Image.fromarray(np.full((20, 30), 30000, dtype=np.uint16)))
+    narrow = _encode(Image.new("L", (30, 20), 10))
+
+    vips, pil = _both_backends(monkeypatch, [wide, narrow])
+
+    # 30000 scales to 117 in 8 bits; round((117 + 10) / 2) == 64.
+    assert np.array_equal(vips, pil)
+    assert (pil == 64).all()
+
+
+def test_backends_agree_on_cmyk_input(monkeypatch):
+    cmyk = _encode(Image.new("CMYK", (30, 20), (20, 200, 90, 30)), "JPEG", quality=95)
+    grey = _encode(Image.new("L", (30, 20), 128))
+
+    vips, pil = _both_backends(monkeypatch, [cmyk, grey])
+
+    assert np.array_equal(vips, pil)
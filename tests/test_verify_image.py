@@ -0,0 +1,45 @@
+import io
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "api"))
+
+import server  # noqa: E402
+
+
+def _upload(name: str) -> UploadFile:
+    return UploadFile(io.BytesIO(), filename=name)
+
+
+def _encode(fmt: str, **kwargs) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), (10, 20, 30)).save(buf, format=fmt, **kwargs)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize(
+    "fmt, kwargs",
+    [
+        ("PNG", {}),
+        ("JPEG", {}),
+        ("WEBP", {}),
+        # Phones write JPEGs with an MP header; Pillow reports them as MPO.
+        ("MPO", {"save_all": True, "append_images": [Image.new("RGB", (8, 8))]}),
+    ],
+)
+def test_accepts_supported_formats(fmt, kwargs):
+    data = _encode(fmt, **kwargs)
+    with Image.open(io.BytesIO(data)) as probe:
+        assert probe.format == fmt
+    server._verify_image(_upload("cam.jpg"), data)
+
+
+@pytest.mark.parametrize("data", [b"notanimage", _encode("GIF")])
+def test_rejects_other_data(data):
+    with pytest.raises(HTTPException) as exc:
+        server._verify_image(_upload("a.png"), data)
+    assert exc.value.status_code == 415